@@ -0,0 +1,94 @@
+"""Compiled dynamic-programming kernel for viterbi_segment in mytext_0.
+
+The vocabulary of a UnigramTextModel is packed into flat arrays (a sorted
+blob of the words' character codes, their offsets, and their log
+probabilities) so that the whole segmentation loop can run under numba
+without touching Python strings or dictionaries.  If numba is not
+installed, _NUMBA_AVAILABLE is False and viterbi_segment uses its NumPy
+implementation instead."""
+
+import numpy as np
+from itertools import imap
+
+try:
+    from numba import njit
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+    def njit(*args, **kwargs):
+        "Stand-in for numba.njit that leaves the function as plain Python."
+        return lambda fn: fn
+
+def encode_text(text):
+    """Return an int32 array with the code of each character of text: the
+    byte value for a str, the code point for unicode.
+    >>> encode_text('ab'), encode_text(u'a\\xe9')
+    (array([97, 98], dtype=int32), array([ 97, 233], dtype=int32))
+    """
+    return np.fromiter(imap(ord, text), dtype=np.int32, count=len(text))
+
+def encode_vocab(logprob_dict):
+    """Pack a {word: logprob} dict into (offsets, blob, logp) arrays, with the
+    words sorted by character codes so viterbi_core can binary-search them.
+    Word k is blob[offsets[k]:offsets[k+1]]."""
+    vocab = sorted(logprob_dict, key=lambda w: map(ord, w))
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum([len(w) for w in vocab])
+    blob = np.zeros(offsets[-1], dtype=np.int32)
+    for (k, w) in enumerate(vocab):
+        blob[offsets[k]:offsets[k+1]] = encode_text(w)
+    logp = np.array([logprob_dict[w] for w in vocab], dtype=np.float64)
+    return offsets, blob, logp
+
+@njit(cache=True)
+def _compare(text, j, i, blob, start, stop):
+    "Compare text[j:i] with blob[start:stop]; return <0, 0 or >0 like cmp."
+    m = min(i - j, stop - start)
+    for t in range(m):
+        if text[j + t] != blob[start + t]:
+            return int(text[j + t]) - int(blob[start + t])
+    return (i - j) - (stop - start)
+
+@njit(cache=True)
+def _lookup(text, j, i, offsets, blob):
+    "Return the index of the word text[j:i] in the vocabulary, or -1."
+    lo = 0
+    hi = len(offsets) - 2
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        c = _compare(text, j, i, blob, offsets[mid], offsets[mid + 1])
+        if c == 0:
+            return mid
+        elif c < 0:
+            hi = mid - 1
+        else:
+            lo = mid + 1
+    return -1
+
+@njit(cache=True)
+def viterbi_core(text, offsets, blob, logp, max_word_len, unknown):
+    """Fill in best[i] (log probability of the best segmentation of
+    text[0:i]) and starts[i] (start of the best word ending at i).
+    text is an encode_text array; unknown is the log probability of unseen
+    words, -inf when the model is not smoothed."""
+    n = len(text)
+    best = np.full(n + 1, -np.inf)
+    best[0] = 0.0
+    starts = np.arange(-1, n)
+    for i in range(1, n + 1):
+        lo = 0
+        if unknown == -np.inf:
+            lo = max(0, i - max_word_len)
+        for j in range(lo, i):
+            if best[j] == -np.inf:
+                continue
+            k = _lookup(text, j, i, offsets, blob)
+            if k >= 0:
+                score = best[j] + logp[k]
+            else:
+                score = best[j] + unknown
+            ## Ties go to the shortest word, i.e. the last j
+            if score > -np.inf and score >= best[i]:
+                best[i] = score
+                starts[i] = j
+    return best, starts
@@ -6,7 +6,13 @@ working on a tiny sample of Unix manual pages."""
 
 from utils import *
 from math import log, exp
-import re, probability, string, search
+import re, probability, string, search, heapq
+from itertools import ifilterfalse, imap
+from multiprocessing.pool import ThreadPool
+from collections import Counter, defaultdict, deque
+import numpy as np
+from _viterbi_numba import (_NUMBA_AVAILABLE, encode_text, encode_vocab,
+                            viterbi_core)
 
 class CountingProbDist(probability.ProbDist):
     """A probability distribution formed by observing and counting examples. 
@@ -14,14 +20,21 @@ class CountingProbDist(probability.ProbDist):
     is an observed value, then there are 3 main operations:
     p.add(o) increments the count for observation o by 1.
     p.sample() returns a random element from the distribution.
+    p.samples_batch(n) returns a list of n random elements.
     p[o] returns the probability for o (as in a regular ProbDist)."""
 
     def __init__(self, observations=[], default=0):
         """Create a distribution, and optionally add in some observations.
         By default this is an unsmoothed distribution, but saying default=1,
-        for example, gives you add-one smoothing."""
+        for example, gives you add-one smoothing.  Fractional defaults give
+        add-k smoothing:
+        >>> P = CountingProbDist('aab', default=0.5)
+        >>> P['a'], P.n_obs
+        (0.625, 4.0)
+        """
         update(self, dictionary=DefaultDict(default), needs_recompute=False,
-               table=[], n_obs=0)
+               _cum=np.zeros(0), _obs=[], n_obs=0,
+               _top_cache={})
         for o in observations:
             self.add(o)
         
@@ -32,13 +45,28 @@ class CountingProbDist(probability.ProbDist):
         self.needs_recompute = True
 
     def sample(self):
-        """Return a random sample from the distribution."""
+        """Return a random sample from the distribution.  Counts may be
+        fractional, as with add-k smoothing:
+        >>> CountingProbDist('a', default=0.25).sample()
+        'a'
+        """
         if self.needs_recompute: self._recompute()
         if self.n_obs == 0:
             return None
-        i = bisect.bisect_left(self.table, (1 + random.randrange(self.n_obs),))
-        (count, o) = self.table[i]
-        return o
+        i = np.searchsorted(self._cum, random.random() * self.n_obs, 'right')
+        return self._obs[i]
+
+    def samples_batch(self, n):
+        """Return a list of n random samples from the distribution, found
+        with a single vectorized search of the cumulative counts.  The draws
+        come from the random module, like sample's, so random.seed makes
+        them reproducible."""
+        if self.needs_recompute: self._recompute()
+        if self.n_obs == 0:
+            return [None] * n
+        rands = np.array([random.random() for _ in xrange(n)]) * self.n_obs
+        found = np.searchsorted(self._cum, rands, 'right')
+        return [self._obs[i] for i in found]
 
     def __getitem__(self, item):
         """Return an estimate of the probability of item."""
@@ -50,19 +78,35 @@ class CountingProbDist(probability.ProbDist):
         return self.n_obs
 
     def top(self, n):
-        "Return (count, obs) tuples for the n most frequent observations."
-        items = [(v, k) for (k, v) in self.dictionary.items()]
-        items.sort(); items.reverse()
-        return items[0:n]
+        """Return (count, obs) tuples for the n most frequent observations.
+        Results are cached by n until the distribution changes."""
+        if self.needs_recompute: self._recompute()
+        if n not in self._top_cache:
+            self._top_cache[n] = self._top(n)
+        return self._top_cache[n][:]
+
+    def _top(self, n):
+        "Compute top(n), with ties broken by the larger observation."
+        return heapq.nlargest(n, [(v, k) for (k, v) in self.dictionary.items()])
+
+    def as_array(self, vocab):
+        "Return an array of the probabilities of each observation in vocab."
+        if self.needs_recompute: self._recompute()
+        d = self.dictionary
+        return np.fromiter((d.get(o, d.default) for o in vocab),
+                           dtype=np.float64, count=len(vocab)) / self.n_obs
 
     def _recompute(self):
-        """Recompute the total count n_obs and the table of entries."""
-        n_obs = 0
-        table = []
-        for (o, count) in self.dictionary.items():
-            n_obs += count
-            table.append((n_obs, o))
-        update(self, n_obs=float(n_obs), table=table, needs_recompute=False)
+        """Recompute the total count n_obs and the table of entries, kept
+        as an array of cumulative counts, _cum, and a parallel list of
+        observations, _obs, for sampling.  The counts are read as floats,
+        since smoothing with a fractional default gives fractional counts."""
+        obs = self.dictionary.keys()
+        cum = np.cumsum(np.fromiter(self.dictionary.itervalues(),
+                                    dtype=np.float64, count=len(obs)))
+        n_obs = cum[-1] if len(cum) else 0
+        update(self, n_obs=float(n_obs), needs_recompute=False,
+               _cum=cum, _obs=obs, _top_cache={})
 
 #______________________________________________________________________________
 
@@ -71,52 +115,244 @@ class UnigramTextModel(CountingProbDist):
     can add, sample, or get P[word], just like with CountingProbDist.  You can
     also generate a random text n words long with P.samples(n)"""
 
+    def __init__(self, observations=[], default=0):
+        ## logprob_dict maps each observed word to log P[word]; it is
+        ## rebuilt along with the table by _recompute.  vocab_arrays is the
+        ## same vocabulary packed for the numba kernel, built on demand.
+        update(self, logprob_dict={}, max_word_len=0, unknown_logprob=-np.inf,
+               vocab_arrays=None)
+        CountingProbDist.__init__(self, observations, default)
+
+    def _recompute(self):
+        """Recompute n_obs and the table, and also the log probability of
+        each observed word, the longest word length, and the log
+        probability given to unseen words (-inf unless smoothed)."""
+        CountingProbDist._recompute(self)
+        if self.n_obs == 0:
+            return
+        log_n = log(self.n_obs)
+        logprob_dict = dict((w, log(c) - log_n)
+                            for (w, c) in self.dictionary.items() if c > 0)
+        unknown_logprob = -np.inf
+        if self.dictionary.default > 0:
+            unknown_logprob = log(self.dictionary.default) - log_n
+        update(self, logprob_dict=logprob_dict,
+               max_word_len=max([len(w) for w in logprob_dict] or [0]),
+               unknown_logprob=unknown_logprob, vocab_arrays=None)
+
     def samples(self, n):
         "Return a string of n words, random according to the model."
-        return ' '.join([self.sample() for i in range(n)])
+        return ' '.join(self.samples_batch(n))
 
 class NgramTextModel(CountingProbDist):
     """This is a discrete probability distribution over n-tuples of words.
     You can add, sample or get P[(word1, ..., wordn)]. The method P.samples(n)
-    builds up an n-word sequence; P.add_text and P.add_sequence add data."""
+    builds up an n-word sequence; P.add_text and P.add_sequence add data.
+    Internally each word is interned as an integer id (vocab maps word to
+    id, inv_vocab id to word), and an n-gram is keyed by its ids packed
+    into a single int (or by the tuple of ids, for n > 3 or once the
+    vocabulary outgrows the packing)."""
 
     def __init__(self, n, observation_sequence=[]):
         ## In addition to the dictionary of n-tuples, cond_prob is a
-        ## mapping from (w1, ..., wn-1) to P(wn | w1, ... wn-1)
+        ## mapping from (w1, ..., wn-1) to P(wn | w1, ... wn-1); both are
+        ## keyed by packed ids, and cond_prob's distributions are over ids.
         CountingProbDist.__init__(self)
         self.n = n
-        self.cond_prob = DefaultDict(CountingProbDist()) 
+        self.cond_prob = defaultdict(CountingProbDist)
+        ## The empty word, used as padding, always has id 0
+        update(self, vocab={'': 0}, inv_vocab=[''], packed=(n <= 3),
+               _keys=np.zeros(0, dtype=np.int64), _counts=np.zeros(0))
         self.add_sequence(observation_sequence)
 
-    ## sample, __len__, __getitem__ inherited from CountingProbDist
-    ## Note they deal with tuples, not strings, as inputs
+    ## __len__ inherited from CountingProbDist
+    ## Note the public methods deal with tuples of words, not ids
 
     def add(self, ngram):
         """Count 1 for P[(w1, ..., wn)] and for P(wn | (w1, ..., wn-1)"""
-        CountingProbDist.add(self, ngram)        
-        self.cond_prob[ngram[:-1]].add(ngram[-1])
+        self._add_ids([self._word_id(w) for w in ngram])
+
+    def _add_ids(self, ids):
+        "Like add, but for an n-gram given as a list of word ids."
+        CountingProbDist.add(self, self._key(ids))
+        self.cond_prob[self._key(ids[:-1])].add(ids[-1])
         
     def add_sequence(self, words):
         """Add each of the tuple words[i:i+n], using a sliding window.
-        Prefix some copies of the empty word, '', to make the start work."""
+        Prefix some copies of the empty word, '', to make the start work.
+        The windows are counted in bulk with numpy.unique, so the
+        dictionaries are updated once per distinct n-gram."""
+        n = self.n
+        ids = np.array([0] * (n-1) + [self._word_id(w) for w in words],
+                       dtype=np.int64)
+        nwindows = len(ids) - n
+        if nwindows <= 0:
+            return
+        windows = _windows(ids, n, nwindows)
+        if self.packed:
+            (keys, counts) = np.unique(_pack(windows), return_counts=True)
+            prefixes = (keys >> _ID_BITS).tolist()
+            lasts = (keys & _ID_MASK).tolist()
+            keys = keys.tolist()
+        else:
+            (rows, counts) = np.unique(windows, axis=0, return_counts=True)
+            lasts = rows[:, -1].tolist()
+            rows = rows.tolist()
+            keys = [tuple(r) for r in rows]
+            prefixes = [tuple(r[:-1]) for r in rows]
+        ## Write through dict.get rather than DefaultDict.__getitem__, which
+        ## would deepcopy the default for every new key
+        dictionary = self.dictionary
+        for (key, prefix, last, count) in zip(keys, prefixes, lasts,
+                                              counts.tolist()):
+            dictionary[key] = dictionary.get(key, dictionary.default) + count
+            dist = self.cond_prob[prefix]
+            dist.dictionary[last] = dist.dictionary.get(last, 0) + count
+            update(dist, n_obs=dist.n_obs + count, needs_recompute=True)
+        self.n_obs += nwindows
+        self.needs_recompute = True
+
+    def _recompute(self):
+        """Recompute n_obs and the table, and, for packed keys, the sorted
+        array of keys (with their counts) that probs searches."""
+        CountingProbDist._recompute(self)
+        if self.packed:
+            m = len(self.dictionary)
+            keys = np.fromiter(self.dictionary.iterkeys(), np.int64, count=m)
+            counts = np.fromiter(self.dictionary.itervalues(), np.float64,
+                                 count=m)
+            order = np.argsort(keys)
+            update(self, _keys=keys[order], _counts=counts[order])
+
+    def probs(self, words):
+        """Return an array of P[ngram] for each of the n-grams in the
+        sequence words (there are len(words)-n+1 of them).  With packed
+        keys this is a single vectorized search instead of a lookup each."""
+        if self.needs_recompute: self._recompute()
         n = self.n
-        words = ['',] * (n-1) + words
-        for i in range(len(words)-n):
-            self.add(tuple(words[i:i+n]))
+        nwindows = len(words) - n + 1
+        if nwindows <= 0:
+            return np.zeros(0)
+        if not self.packed:
+            return np.array([self[tuple(words[i:i+n])]
+                             for i in range(nwindows)])
+        ids = np.array([self.vocab.get(w, -1) for w in words], dtype=np.int64)
+        windows = _windows(ids, n, nwindows)
+        keys = _pack(windows)
+        counts = np.full(nwindows, float(self.dictionary.default))
+        if len(self._keys):
+            i = np.searchsorted(self._keys, keys).clip(0, len(self._keys) - 1)
+            ## Windows containing an unseen word (id -1) never match
+            found = (windows >= 0).all(axis=1) & (self._keys[i] == keys)
+            counts[found] = self._counts[i[found]]
+        return counts / self.n_obs
+
+    def __getitem__(self, ngram):
+        """Return an estimate of the probability of the tuple ngram."""
+        if self.needs_recompute: self._recompute()
+        if not all(w in self.vocab for w in ngram):
+            return self.dictionary.default / self.n_obs
+        return self.dictionary[self._key([self.vocab[w] for w in ngram])] / self.n_obs
+
+    def sample(self):
+        """Return a random n-tuple of words from the distribution."""
+        key = CountingProbDist.sample(self)
+        if key is None:
+            return None
+        return self._decode(key)
+
+    def _top(self, n):
+        """Compute top(n) for n-grams.  Only the keys whose count could
+        make the top n are decoded, so ties still break on the words."""
+        counts = heapq.nlargest(n, self.dictionary.itervalues())
+        if not counts:
+            return []
+        items = [(v, self._decode(k)) for (k, v) in self.dictionary.items()
+                 if v >= counts[-1]]
+        return heapq.nlargest(n, items)
+
+    def conditional(self, prefix):
+        "Return the {word: count} dict of words seen following prefix."
+        if not all(w in self.vocab for w in prefix):
+            return {}
+        dist = self.cond_prob[self._key([self.vocab[w] for w in prefix])]
+        return dict((self.inv_vocab[i], c) for (i, c) in dist.dictionary.items())
 
     def samples(self, nwords):
         """Build up a random sample of text n words long, using the"""
         n = self.n
-        nminus1gram = ('',) * (n-1)
+        nminus1gram = (0,) * (n-1)
         output = []
         while len(output) < nwords:
-            wn = self.cond_prob[nminus1gram].sample()
+            wn = self.cond_prob[self._key(nminus1gram)].sample()
             if wn:
-                output.append(wn)
+                output.append(self.inv_vocab[wn])
                 nminus1gram = nminus1gram[1:] + (wn,)
             else: ## Cannot continue, so restart.
-                nminus1gram = ('',) * (n-1)
+                nminus1gram = (0,) * (n-1)
         return ' '.join(output)
+
+    def _word_id(self, word):
+        "Return the id of word, adding it to the vocabulary if it is new."
+        i = self.vocab.get(word)
+        if i is None:
+            i = len(self.inv_vocab)
+            if self.packed and i > _ID_MASK:
+                self._unpack()
+            self.vocab[word] = i
+            self.inv_vocab.append(word)
+        return i
+
+    def _unpack(self):
+        """Switch from packed keys to tuples of ids, re-keying the
+        dictionaries; used once the vocabulary no longer fits in _ID_BITS."""
+        dictionary = DefaultDict(self.dictionary.default)
+        for (key, count) in self.dictionary.items():
+            dictionary[_unpack_key(key, self.n)] = count
+        cond_prob = defaultdict(CountingProbDist)
+        for (prefix, dist) in self.cond_prob.items():
+            cond_prob[_unpack_key(prefix, self.n - 1)] = dist
+        update(self, dictionary=dictionary, cond_prob=cond_prob, packed=False,
+               _keys=np.zeros(0, dtype=np.int64), _counts=np.zeros(0),
+               needs_recompute=True)
+
+    def _key(self, ids):
+        "Return the dictionary key for a sequence of word ids."
+        if not self.packed:
+            return tuple(ids)
+        key = 0
+        for i in ids:
+            key = (key << _ID_BITS) | i
+        return key
+
+    def _decode(self, key):
+        "Return the tuple of words for an n-gram dictionary key."
+        if self.packed:
+            key = _unpack_key(key, self.n)
+        return tuple([self.inv_vocab[i] for i in key])
+
+## Bits per word id in a packed n-gram key; 3 ids fit in a 64-bit int.
+_ID_BITS = 21
+_ID_MASK = (1 << _ID_BITS) - 1
+
+def _unpack_key(key, n):
+    "Return the tuple of the n word ids packed into key."
+    ids = []
+    for _ in range(n):
+        ids.append(key & _ID_MASK)
+        key >>= _ID_BITS
+    return tuple(reversed(ids))
+
+def _windows(ids, n, nwindows):
+    "Return an (nwindows, n) array whose row i is ids[i:i+n]."
+    return np.column_stack([ids[k:k+nwindows] for k in range(n)])
+
+def _pack(windows):
+    "Return the packed int64 key of each row of an array of word ids."
+    keys = np.zeros(len(windows), dtype=np.int64)
+    for k in range(windows.shape[1]):
+        keys = (keys << _ID_BITS) | windows[:, k]
+    return keys
     
 #______________________________________________________________________________
 
@@ -124,25 +360,64 @@ class NgramTextModel(CountingProbDist):
 def viterbi_segment(text, P):
     """Find the best segmentation of the string of characters, given the 
     UnigramTextModel P."""
-    # best[i] = best probability for text[0:i]
-    # words[i] = best word ending at position i
+    if P.needs_recompute: P._recompute()
+    if _NUMBA_AVAILABLE:
+        return _viterbi_segment_numba(text, P)
+    return _viterbi_segment_numpy(text, P)
+
+def _viterbi_segment_numpy(text, P):
+    "Run viterbi_segment's dynamic programming with NumPy arrays."
+    # best[i] = best log probability for text[0:i]
+    # starts[i] = start of the best word ending at position i
+    logP, unknown = P.logprob_dict, P.unknown_logprob
     n = len(text)
-    words = [''] + list(text)
-    best = [1.0] + [0.0] * n
-    ## Fill in the vectors best, words via dynamic programming
-    for i in range(n+1):
-        for j in range(0, i):
-            w = text[j:i]
-            if P[w] * best[i - len(w)] >= best[i]:
-                best[i] = P[w] * best[i - len(w)]
-                words[i] = w
-    ## Now recover the sequence of best words
-    sequence = []; i = len(words)-1
+    best = np.full(n+1, -np.inf)
+    best[0] = 0.0
+    starts = np.arange(-1, n)
+    ## Fill in the vectors best, starts via dynamic programming.  Unless the
+    ## model is smoothed, only words up to the longest known one can match.
+    for i in range(1, n+1):
+        if unknown == -np.inf:
+            js = np.arange(max(0, i - P.max_word_len), i)
+        else:
+            js = np.arange(0, i)
+        logps = np.array([logP.get(text[j:i], unknown) for j in js])
+        scores = best[js] + logps
+        if len(scores) == 0 or scores.max() == -np.inf:
+            continue
+        ## Ties go to the shortest word, i.e. the last maximum
+        k = len(scores) - 1 - np.argmax(scores[::-1])
+        best[i] = scores[k]
+        starts[i] = js[k]
+    return _best_sequence(text, best, starts)
+
+def _viterbi_segment_numba(text, P):
+    """Run viterbi_segment's dynamic programming in the compiled kernel.
+    It gives the same answers as the NumPy version, for str or unicode:
+    >>> P = UnigramTextModel(u'the cat sat on the caf\\xe9 ol\\xe9'.split())
+    >>> for text in ['thecatsat', u'thecatsat', u'caf\\xe9ol\\xe9', 'zq']:
+    ...     assert (_viterbi_segment_numba(text, P) ==
+    ...             _viterbi_segment_numpy(text, P)), text
+    >>> _viterbi_segment_numba('thecatsat', P)[0]
+    ['the', 'cat', 'sat']
+    """
+    if P.needs_recompute: P._recompute()
+    if P.vocab_arrays is None:
+        P.vocab_arrays = encode_vocab(P.logprob_dict)
+    offsets, blob, logp = P.vocab_arrays
+    best, starts = viterbi_core(encode_text(text),
+                                offsets, blob, logp, P.max_word_len,
+                                P.unknown_logprob)
+    return _best_sequence(text, best, starts)
+
+def _best_sequence(text, best, starts):
+    """Recover the sequence of best words from viterbi_segment's vectors,
+    and return it along with the overall probability."""
+    sequence = []; i = len(text)
     while i > 0:
-        sequence[0:0] = [words[i]]
-        i = i - len(words[i])
-    ## Return sequence of best words and overall probability
-    return sequence, best[-1]
+        sequence[0:0] = [text[starts[i]:i]]
+        i = starts[i]
+    return sequence, exp(best[-1])
     
 
 #______________________________________________________________________________
@@ -160,25 +435,70 @@ class IRSystem:
     def __init__(self, stopwords='the a of'):
         """Create an IR System. Optionally specify stopwords."""
         ## index is a map of {word: {docid: count}}, where docid is an int,
-        ## indicating the index into the documents list.
-        update(self, index=DefaultDict(DefaultDict(0)), 
-               stopwords=set(words(stopwords)), documents=[])
+        ## indicating the index into the documents list.  finalize_index
+        ## moves it into postings, a map of {word: (docids, counts)} arrays
+        ## sorted by docid, which is what queries are answered from.
+        update(self, index={}, postings={},
+               log_nwords=np.zeros(0), needs_finalize=False,
+               stopwords=frozenset(words(stopwords)), documents=[])
 
     def index_collection(self, filenames):
-        "Index a whole collection of files."
-        for filename in filenames:
-            self.index_document(open(filename).read(), filename)
+        """Index a whole collection of files.  A pool of threads reads the
+        files ahead, so disk latency overlaps with indexing; the indexing
+        itself stays on this thread, in order, since it mutates the index.
+        At most _READ_AHEAD files are read but not yet indexed, so the
+        collection is never all in memory at once."""
+        pool = ThreadPool(_READ_THREADS)
+        pending = deque()
+        try:
+            for filename in filenames:
+                pending.append((filename,
+                                pool.apply_async(_read_file, (filename,))))
+                if len(pending) >= _READ_AHEAD:
+                    (name, result) = pending.popleft()
+                    self.index_document(result.get(), name)
+            for (name, result) in pending:
+                self.index_document(result.get(), name)
+        finally:
+            pool.terminate()
+        self.finalize_index()
+
+    def finalize_index(self):
+        """Move the counts gathered by index_document into the postings
+        arrays, and gather each document's log(1 + nwords) into an array."""
+        for (word, doccounts) in self.index.items():
+            items = sorted(doccounts.items())
+            docids = np.array([d for (d, c) in items], dtype=np.int32)
+            counts = np.array([c for (d, c) in items], dtype=np.int32)
+            if word in self.postings:
+                ## New docids are always larger, so this stays sorted
+                (old_docids, old_counts) = self.postings[word]
+                docids = np.concatenate((old_docids, docids))
+                counts = np.concatenate((old_counts, counts))
+            self.postings[word] = (docids, counts)
+        log_nwords = np.array([d.log_nwords for d in self.documents])
+        update(self, index={}, log_nwords=log_nwords,
+               needs_finalize=False)
+
+    def posting(self, word):
+        "Return the (docids, counts) arrays for word; empty if it is unseen."
+        return self.postings.get(word, _EMPTY_POSTING)
 
     def index_document(self, text, url):
         "Index the text of a document."
         ## For now, use first line for title
         title = text[:text.index('\n')].strip()
-        docwords = words(text)
         docid = len(self.documents)
+        ## Lowercase each word as it is indexed, rather than building a
+        ## lowercased copy of the text
+        docwords = _WORD_RE.findall(text)
         self.documents.append(Document(title, url, len(docwords)))
-        for word in docwords:
-            if word not in self.stopwords:
-                self.index[word][docid] += 1
+        counts = Counter(ifilterfalse(self.stopwords.__contains__,
+                                      (w.lower() for w in docwords)))
+        ## One write per distinct word, rather than one per occurrence
+        for (word, count) in counts.iteritems():
+            self.index.setdefault(word, {})[docid] = count
+        self.needs_finalize = True
 
     def query(self, query_text, n=10):
         """Return a list of n (score, docid) pairs for the best matches.
@@ -187,18 +507,25 @@ class IRSystem:
             doctext = os.popen(query_text[len("learn:"):], 'r').read()
             self.index_document(doctext, query_text)
             return []
-        qwords = [w for w in words(query_text) if w not in self.stopwords]
-        shortest = argmin(qwords, lambda w: len(self.index[w]))
-        docs = self.index[shortest]
-        results = [(sum([self.score(w, d) for w in qwords]), d) for d in docs]
-        results.sort(); results.reverse()
-        return results[:n]
+        if self.needs_finalize: self.finalize_index()
+        qwords = list(ifilterfalse(self.stopwords.__contains__,
+                                   words(query_text)))
+        shortest = argmin(qwords, lambda w: len(self.posting(w)[0]))
+        docs = self.posting(shortest)[0]
+        scores = sum([self.score(w, docs) for w in qwords])
+        return heapq.nlargest(n, zip(scores.tolist(), docs.tolist()))
 
     def score(self, word, docid):
-        "Compute a score for this word on this docid."
+        """Compute a score for this word on this docid.  docid may also be
+        an array of docids, giving an array of scores."""
         ## There are many options; here we take a very simple approach
-        return (math.log(1 + self.index[word][docid])
-                / math.log(1 + self.documents[docid].nwords))
+        if self.needs_finalize: self.finalize_index()
+        (docids, counts) = self.posting(word)
+        count = np.zeros(np.shape(docid), dtype=np.int32)
+        if len(docids):
+            i = np.searchsorted(docids, docid).clip(0, len(docids) - 1)
+            count = np.where(docids[i] == docid, counts[i], 0)
+        return np.log1p(count) / self.log_nwords[docid]
 
     def present(self, results):
         "Present the results as a list."
@@ -210,6 +537,22 @@ class IRSystem:
         "Get results for the query and present them."
         self.present(self.query(query_text, n))
 
+_EMPTY_POSTING = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+
+## Number of threads IRSystem.index_collection reads files with
+_READ_THREADS = 8
+
+## Number of files IRSystem.index_collection reads ahead of the indexing
+_READ_AHEAD = 2 * _READ_THREADS
+
+def _read_file(filename):
+    "Return the contents of a file."
+    f = open(filename)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
 class UnixConsultant(IRSystem):
     """A trivial IR system over a small collection of Unix man pages."""
     def __init__(self):
@@ -223,7 +566,8 @@ class UnixConsultant(IRSystem):
 class Document:
     """Metadata for a document: title and url; maybe add others later."""
     def __init__(self, title, url, nwords):
-        update(self, title=title, url=url, nwords=nwords)
+        update(self, title=title, url=url, nwords=nwords,
+               log_nwords=math.log1p(nwords))
 
 def words(text, reg=re.compile('[a-z0-9]+')):
     """Return a list of the words in text, ignoring punctuation and
@@ -231,7 +575,16 @@ def words(text, reg=re.compile('[a-z0-9]+')):
     >>> words("``EGAD!'' Edgar cried.")
     ['egad', 'edgar', 'cried']
     """
-    return reg.findall(text.lower())
+    if isinstance(text, unicode):
+        return reg.findall(text.lower())
+    ## Byte strings are lowercased with a fixed ASCII table, which is
+    ## faster than the locale-aware str.lower()
+    return reg.findall(text.translate(_LOWER_TABLE))
+
+_LOWER_TABLE = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+## The words of a document before lowercasing, for IRSystem.index_document
+_WORD_RE = re.compile('[A-Za-z0-9]+')
 
 def canonicalize(text):
     """Return a canonical text: only lowercase letters and blanks.
@@ -252,9 +605,13 @@ def canonicalize(text):
 
 def shift_encode(plaintext, n):
     """Encode text with a shift cipher that moves each letter up by n letters.
-    >>> shift_encode('abc z', 1)
-    'bcd a'
+    >>> shift_encode('abc z', 1), shift_encode(u'abc z', 1)
+    ('bcd a', u'bcd a')
     """
+    if -len(alphabet) <= n < len(alphabet):
+        if isinstance(plaintext, unicode):
+            return plaintext.translate(_SHIFT_UNICODE_TABLES[n])
+        return plaintext.translate(_SHIFT_TABLES[n])
     return encode(plaintext, alphabet[n:] + alphabet[:n])
     
 def rot13(plaintext):
@@ -273,6 +630,21 @@ def encode(plaintext, code):
     return plaintext.translate(trans)
 
 alphabet = 'abcdefghijklmnopqrstuvwxyz'  
+
+## The translation table for shift_encode by each n, built once
+_SHIFT_TABLES = tuple([string.maketrans(
+    alphabet + alphabet.upper(),
+    alphabet[n:] + alphabet[:n] + (alphabet[n:] + alphabet[:n]).upper())
+    for n in range(len(alphabet))])
+
+## The same tables as {code point: code point} dicts, for unicode text
+_SHIFT_UNICODE_TABLES = tuple([
+    dict((ord(c), ord(table[ord(c)])) for c in alphabet + alphabet.upper())
+    for table in _SHIFT_TABLES])
+
+## Row n maps each byte to its shift_encode by n, for ShiftDecoder.decode
+_SHIFT_BYTES = np.array([np.frombuffer(table, dtype=np.uint8)
+                         for table in _SHIFT_TABLES])
     
 def bigrams(text):
     """Return a list of pairs in text (a sequence of letters or words).
@@ -283,6 +655,27 @@ def bigrams(text):
     """
     return [text[i:i+2] for i in range(len(text) - 1)]
 
+def _byte_codes(text):
+    """Return the byte code of each character of text as a uint8 array.
+    Unicode characters past Latin-1 map to 0, which no canonical text has.
+    >>> _byte_codes('hi'), _byte_codes(u'h\\xe9\\u4e2d')
+    (array([104, 105], dtype=uint8), array([104, 233,   0], dtype=uint8))
+    """
+    if isinstance(text, unicode):
+        codes = np.fromiter(imap(ord, text), dtype=np.int32, count=len(text))
+        return np.where(codes < 256, codes, 0).astype(np.uint8)
+    return np.frombuffer(text, dtype=np.uint8)
+
+def bigrams_char_counts(text):
+    """Return a 256x256 array whose [i, j] entry counts the occurrences of
+    the letter pair chr(i) + chr(j) in text, without building the pairs.
+    >>> bigrams_char_counts('this')[ord('h'), ord('i')]
+    1
+    """
+    codes = _byte_codes(text).astype(np.intp)
+    pairs = codes[:-1] * 256 + codes[1:]
+    return np.bincount(pairs, minlength=256 * 256).reshape(256, 256)
+
 #### Decoding a Shift (or Caesar) Cipher
 
 class ShiftDecoder:
@@ -291,18 +684,26 @@ class ShiftDecoder:
     bigram probability distribution."""
     def __init__(self, training_text):
         training_text = canonicalize(training_text)
-        self.P2 = CountingProbDist(bigrams(training_text), default=1)
+        ## log_P2[i, j] is the log probability of the bigram chr(i) + chr(j),
+        ## with add-one smoothing on the bigrams seen in training (the same
+        ## estimate as CountingProbDist(bigrams(text), default=1))
+        counts = bigrams_char_counts(training_text)
+        n_obs = float(counts.sum() + np.count_nonzero(counts))
+        self.log_P2 = np.log((counts + 1) / n_obs)
 
     def score(self, plaintext):
         "Return a score for text based on how common letters pairs are."
-        s = 1.0
-        for bi in bigrams(plaintext):
-            s = s * self.P2[bi]
-        return s
+        codes = _byte_codes(plaintext)
+        return exp(self.log_P2[codes[:-1], codes[1:]].sum())
     
     def decode(self, ciphertext):
         "Return the shift decoding of text with the best score."
-        return argmax(all_shifts(ciphertext), self.score)
+        ## Row n of shifted is the ciphertext shifted by n, as byte codes.
+        ## Summing log probabilities scores all 26 rows at once, and does
+        ## not underflow to 0 on long texts the way the products would.
+        shifted = _SHIFT_BYTES[:, _byte_codes(ciphertext)]
+        scores = self.log_P2[shifted[:, :-1], shifted[:, 1:]].sum(axis=1)
+        return shift_encode(ciphertext, int(np.argmax(scores)))
 
 def all_shifts(text):
     "Return a list of all 26 possible encodings of text by a shift cipher."
@@ -328,24 +729,59 @@ class PermutationDecoder:
         self.Pwords = UnigramTextModel(words(training_text))
         self.P1 = UnigramTextModel(training_text) # By letter
         self.P2 = NgramTextModel(2, training_text) # By letter pair
+        self.score_cache = {}
+        ## The letter and letter pair log probabilities, indexed by byte
+        ## code, so score can look up all of a text's letters at once.
+        ## Letters past Latin-1 are left out, as _byte_codes maps them to 0.
+        for P in (self.Pwords, self.P1, self.P2):
+            if P.needs_recompute: P._recompute()
+        self.log_P1 = np.full(256, -np.inf)
+        for (c, logp) in self.P1.logprob_dict.items():
+            if ord(c) < 256:
+                self.log_P1[ord(c)] = logp
+        self.log_P2 = np.full((256, 256), -np.inf)
+        for (key, count) in self.P2.dictionary.items():
+            (a, b) = self.P2._decode(key)
+            if count > 0 and a and b and ord(a) < 256 and ord(b) < 256:
+                self.log_P2[ord(a), ord(b)] = log(count / self.P2.n_obs)
         if ciphertext:
             return self.decode(ciphertext)
 
     def decode(self, ciphertext):
         "Search for a decoding of the ciphertext."
         self.ciphertext = ciphertext
+        self.score_cache.clear()
         problem = PermutationDecoderProblem(decoder=self)
         return search.best_first_tree_search(problem, self.score)
 
     def score(self, ciphertext, code):
         """Score is product of word scores, unigram scores, and bigram scores.
-        This can get very small, so we use logs and exp."""
+        This can get very small, so we use logs and exp.  The search reaches
+        the same partial codes many times, so scores are memoized in
+        score_cache, which decode clears."""
+        key = (ciphertext, frozenset(code.items()))
+        if key not in self.score_cache:
+            if len(self.score_cache) >= _SCORE_CACHE_SIZE:
+                self.score_cache.clear()
+            self.score_cache[key] = self._score(ciphertext, code)
+        return self.score_cache[key]
+
+    def _score(self, ciphertext, code):
+        "Compute score(ciphertext, code) without the cache."
         text = decode(ciphertext, code)
-        logP = (sum([log(self.Pwords[word]) for word in words(text)]) +
-                sum([log(self.P1[c]) for c in text]) +
-                sum([log(self.P2[b]) for b in bigrams(text)]))
+        codes = _byte_codes(text)
+        ## Each distinct word is looked up once, weighted by its count
+        logPwords = sum([n * self.Pwords.logprob_dict.get(
+                             word, self.Pwords.unknown_logprob)
+                         for (word, n) in Counter(words(text)).iteritems()])
+        logP = (logPwords +
+                self.log_P1[codes].sum() +
+                self.log_P2[codes[:-1], codes[1:]].sum())
         return exp(logP)
 
+## The most scores a PermutationDecoder memoizes before starting afresh
+_SCORE_CACHE_SIZE = 1 << 16
+
 class PermutationDecoderProblem(search.Problem):
     def __init__(self, initial=None, goal=None, decoder=None):
         self.initial = initial or {}
@@ -365,13 +801,19 @@ class PermutationDecoderProblem(search.Problem):
 #______________________________________________________________________________
 
 def simscore(list1, list2):
+    # Position of the first occurrence of each item, as list.index would give
+    index1 = {}
+    for (i, item) in enumerate(list1):
+        index1.setdefault(item, i)
+    index2 = {}
+    for (i, item) in enumerate(list2):
+        index2.setdefault(item, i)
     matchcount = 0
     totaldiff = 0
     for item in list2:
-        if item in list1:
+        if item in index1:
             matchcount +=1
-            #  not very efficient, but who cares?
-            diff = abs(list1.index(item)-list2.index(item))
+            diff = abs(index1[item]-index2[item])
             totaldiff += diff
     score = ((1/float(1+(0.1*totaldiff)))*matchcount)/len(list1)
     return (score, matchcount, totaldiff)
@@ -474,10 +916,6 @@ def mycode():
     print ''
     # This prints a bunch of interesting statistical information
     # out to the screen.
-    Bleakprob = 0
-    moonstoneprob = 0
-    Bleakcount = 0
-    moonstonecount = 0
     secrettotalwords = len(wordseqsecret)
     print "Bleak the prob: " + str(P1Bleak['the'])
     print "moonstone the prob: " + str(P1moonstone['the'])
@@ -492,55 +930,40 @@ def mycode():
     # This goes through each word in secret, notes how likely that word
     # is in one of the other texts and keeps a running total.
     # It also just counts the number of words in secret that appear in
-    # the other texts.
-    for word in wordseqsecret:
-        p1wordBleak = P1Bleak[word]
-        p1wordmoonstone = P1moonstone[word]
-        if p1wordBleak > 0:
-            Bleakcount += 1
-        Bleakprob = Bleakprob + p1wordBleak
-        if p1wordmoonstone > 0:
-            moonstonecount += 1
-        moonstoneprob = moonstoneprob + p1wordmoonstone
-        # print "word: " + word + " wordprob: " + str(p1wordmoonstone) + " moonstoneprob: " + str(moonstoneprob)        
+    # the other texts.  The words are encoded once as ids into secret's
+    # vocabulary, so each model is consulted once per distinct word.
+    (secretvocab, secretids) = np.unique(wordseqsecret, return_inverse=True)
+    secretvocab = secretvocab.tolist()
+    p1wordsBleak = P1Bleak.as_array(secretvocab)[secretids]
+    p1wordsmoonstone = P1moonstone.as_array(secretvocab)[secretids]
+    Bleakprob = float(p1wordsBleak.sum())
+    moonstoneprob = float(p1wordsmoonstone.sum())
+    Bleakcount = np.count_nonzero(p1wordsBleak)
+    moonstonecount = np.count_nonzero(p1wordsmoonstone)
     print "Bleak probability is: " + str(Bleakprob)
     print "moonstone probability is: " + str(moonstoneprob)
     print "Bleak count and prob are: " + str(Bleakcount) + " " + str(Bleakcount/float(secrettotalwords))
     print "moonstone count and prob are: " + str(moonstonecount) + " " + str(moonstonecount/float(secrettotalwords))
 
     # This does the same kind of thing as above with bigrams.
-    Bleak2prob = 0
-    moonstone2prob = 0
-    Bleak2count = 0
-    moonstone2count = 0
-    for index in xrange(1, len(wordseqsecret)):
-        p2wordsBleak = P2Bleak[wordseqsecret[index-1],wordseqsecret[index]]
-        p2wordsmoonstone = P2moonstone[wordseqsecret[index-1],wordseqsecret[index]]
-        if p2wordsBleak > 0:
-            Bleak2count +=1
-        Bleak2prob = Bleak2prob + p2wordsBleak
-        if p2wordsmoonstone > 0:
-            moonstone2count +=1
-        moonstone2prob = moonstone2prob + p2wordsmoonstone
+    p2wordsBleak = P2Bleak.probs(wordseqsecret)
+    p2wordsmoonstone = P2moonstone.probs(wordseqsecret)
+    Bleak2prob = float(p2wordsBleak.sum())
+    moonstone2prob = float(p2wordsmoonstone.sum())
+    Bleak2count = np.count_nonzero(p2wordsBleak)
+    moonstone2count = np.count_nonzero(p2wordsmoonstone)
     print "Bleak bigram prob is: " + str(Bleak2prob)
     print "moonstone bigram prob is: " + str(moonstone2prob)
     print "Bleak bigram count and prob are: " + str(Bleak2count) + " " + str(Bleak2count/float(secrettotalwords))
     print "moonstone bigram count and prob are: " + str(moonstone2count) + " " + str(moonstone2count/float(secrettotalwords))
 
     # The same thing yet again with trigrams.
-    Bleak3prob = 0
-    moonstone3prob = 0
-    Bleak3count = 0
-    moonstone3count = 0
-    for index in xrange(2, len(wordseqsecret)):
-        p3wordsBleak = P3Bleak[wordseqsecret[index-2],wordseqsecret[index-1],wordseqsecret[index]]
-        p3wordsmoonstone = P3moonstone[wordseqsecret[index-2],wordseqsecret[index-1],wordseqsecret[index]]
-        if p3wordsBleak > 0:
-            Bleak3count +=1
-        Bleak3prob = Bleak3prob + p3wordsBleak
-        if p3wordsmoonstone > 0:
-            moonstone3count +=1
-        moonstone3prob = moonstone3prob + p3wordsmoonstone
+    p3wordsBleak = P3Bleak.probs(wordseqsecret)
+    p3wordsmoonstone = P3moonstone.probs(wordseqsecret)
+    Bleak3prob = float(p3wordsBleak.sum())
+    moonstone3prob = float(p3wordsmoonstone.sum())
+    Bleak3count = np.count_nonzero(p3wordsBleak)
+    moonstone3count = np.count_nonzero(p3wordsmoonstone)
     print "Bleak trigram prob is: " + str(Bleak3prob)
     print "moonstone trigram prob is: " + str(moonstone3prob)
     print "Bleak trigram count and prob are: " + str(Bleak3count) + " " + str(Bleak3count/float(secrettotalwords))
@@ -625,8 +1048,9 @@ __doc__ += """
 0.00032318721353860618
 
 ## Distributions given the previous n-1 words
->>> P2.cond_prob['went',].dictionary
->>> P3.cond_prob['in', 'order'].dictionary
+>>> P2.conditional(('went',))
+{}
+>>> P3.conditional(('in', 'order'))
 {'to': 6}
 
 ## Build and test an IR System